@@ -0,0 +1,190 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+
+import generate_kcm
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+LANGUAGES_CSV = os.path.join(REPO_DIR, 'languages.csv')
+
+# Strings fed to unicode_escape, one per script family the mappings cover
+ESCAPE_SAMPLES = [
+    'qwertyuiopasdfghjklzxcvbnm',
+    'йцукенгшщзхфывапролджэячсмитьбю',
+    'αβγδεζηθικλμνξοπρστυφχψω',
+    'ابتثجحخدذرزسشصضطظعغفقكلمنهوي',
+    'अआइईउऊऋएऐओऔकखगघङचछजझञ',
+    'たていすかんなにらせちとしはきくまのりつさそひこみも',
+    '一丨丿丶乙亅二八冂亠人儿入刀力勹匕匚十口囗土士夂夊夕',
+    'aй1βب2ि3た4一5\\\\~«»¥€£',
+]
+
+def time_call(func, repeat, number=1):
+    # Best-of style timing: returns per-call seconds for each of `repeat` batches of `number` calls
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+def summarize(samples, **extra):
+    result = {
+        'runs': len(samples),
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+    }
+    result.update(extra)
+    return result
+
+def write_synthetic_csv(path, rows):
+    # Scale languages.csv up to `rows` rows by cycling its locales under unique file names
+    with open(LANGUAGES_CSV, 'r', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        languages = list(reader)
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for i in range(rows):
+            lang = dict(languages[i % len(languages)])
+            for _, column in generate_kcm.LAYOUT_COLUMNS:
+                if lang[column]:
+                    lang[column] = '{}_{}.kcm'.format(lang[column][:-len('.kcm')], i)
+            writer.writerow(lang)
+
+def bench_import(repeat):
+    # Wall time of a fresh interpreter importing the generator, minus bare interpreter startup
+    def run(code):
+        subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, check=True)
+
+    startup = time_call(lambda: run('pass'), repeat)
+    total = time_call(lambda: run('import generate_kcm'), repeat)
+    return summarize(
+        [t - min(startup) for t in total],
+        interpreter_startup=min(startup),
+    )
+
+def bench_unicode_escape(repeat):
+    number = 2000
+
+    def run():
+        for sample in ESCAPE_SAMPLES:
+            generate_kcm.unicode_escape(sample)
+
+    return summarize(time_call(run, repeat, number), chars=sum(len(s) for s in ESCAPE_SAMPLES))
+
+def bench_generate_kcm_file(repeat, output_dir, cold):
+    # One file per call; cold runs drop the compiled key tables first
+    number = 50
+
+    def run():
+        if cold:
+            generate_kcm.invalidate_key_tables()
+        generate_kcm.generate_kcm_file('ru_translit', 'QWERTY', 'keyboard_qwerty_ru.kcm', output_dir)
+
+    return summarize(time_call(run, repeat, number))
+
+def bench_main(repeat, language_list, output_dir):
+    # Full serial build with cold caches and no incremental skipping
+    def run():
+        generate_kcm.invalidate_key_tables()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            generate_kcm.main(language_list, output_dir, force=True)
+
+    with open(language_list, 'r', encoding='utf-8') as f:
+        files = len(generate_kcm.build_work_units(list(csv.DictReader(f))))
+
+    samples = time_call(run, repeat)
+    return summarize(samples, files=files, files_per_second=files / min(samples))
+
+def run_benchmarks(repeat, rows, only=None):
+    work_dir = tempfile.mkdtemp(prefix='bench_kcm_')
+    try:
+        synthetic_csv = os.path.join(work_dir, 'languages_synthetic.csv')
+        write_synthetic_csv(synthetic_csv, rows)
+        output_dir = os.path.join(work_dir, 'out')
+
+        benchmarks = [
+            ('import', lambda: bench_import(repeat)),
+            ('unicode_escape', lambda: bench_unicode_escape(repeat)),
+            ('generate_kcm_file_cold', lambda: bench_generate_kcm_file(repeat, output_dir, cold=True)),
+            ('generate_kcm_file_warm', lambda: bench_generate_kcm_file(repeat, output_dir, cold=False)),
+            ('main_languages_csv', lambda: bench_main(repeat, LANGUAGES_CSV, output_dir)),
+            ('main_synthetic_csv', lambda: bench_main(repeat, synthetic_csv, output_dir)),
+        ]
+
+        results = {}
+        for name, bench in benchmarks:
+            if only and name not in only:
+                continue
+            print("Running {}".format(name), file=sys.stderr)
+            results[name] = bench()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'synthetic_rows': rows,
+        'results': results,
+    }
+
+def compare(baseline, current, threshold):
+    # Prints median timings side by side, returns the names that got slower than threshold allows
+    regressions = []
+    print("{:<26} {:>12} {:>12} {:>8}".format('benchmark', 'baseline', 'current', 'change'))
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            print("{:<26} {:>12} {:>12.6f} {:>8}".format(name, '-', result['median'], 'new'))
+            continue
+        old = baseline['results'][name]['median']
+        change = (result['median'] - old) / old if old else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("{:<26} {:>12.6f} {:>12.6f} {:>+7.1%}{}".format(name, old, result['median'], change, flag))
+    return regressions
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark KCM generation throughput and startup time')
+    parser.add_argument('-o', '--output', help='Write results as JSON to this file (default: stdout)')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='Compare against a previous JSON result and exit 1 on regressions')
+    parser.add_argument('-t', '--threshold', type=float, default=0.10,
+                        help='Allowed slowdown of the median before it counts as a regression (default: 0.10)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Timed runs per benchmark (default: 5)')
+    parser.add_argument('--rows', type=int, default=2000,
+                        help='Rows in the synthetic languages.csv (default: 2000)')
+    parser.add_argument('--only', action='append', metavar='NAME', help='Run only this benchmark, repeatable')
+
+    args = parser.parse_args()
+
+    current = run_benchmarks(args.repeat, args.rows, args.only)
+
+    report = json.dumps(current, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report)
+    elif not args.compare:
+        sys.stdout.write(report)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
@@ -1,31 +1,39 @@
 import os
+import io
 import csv
+import sys
+import json
+import time
+import re
+import marshal
+import posixpath
+import hashlib
+import tempfile
+import functools
 from collections import defaultdict
+from collections.abc import Mapping
 
-# Define physical layouts
-PHYSICAL_LAYOUTS = {
-    'QWERTY': {
-        'key_mapping': {
-            16: 'Q', 17: 'W', 18: 'E', 19: 'R', 20: 'T', 21: 'Y', 22: 'U', 23: 'I', 24: 'O', 25: 'P',
-            30: 'A', 31: 'S', 32: 'D', 33: 'F', 34: 'G', 35: 'H', 36: 'J', 37: 'K', 38: 'L',
-            44: 'Z', 45: 'X', 46: 'C', 47: 'V', 48: 'B', 49: 'N', 50: 'M'
-        }
-    },
-    'AZERTY': {
-        'key_mapping': {
-            16: 'A', 17: 'Z', 18: 'E', 19: 'R', 20: 'T', 21: 'Y', 22: 'U', 23: 'I', 24: 'O', 25: 'P',
-            30: 'Q', 31: 'S', 32: 'D', 33: 'F', 34: 'G', 35: 'H', 36: 'J', 37: 'K', 38: 'L',
-            44: 'W', 45: 'X', 46: 'C', 47: 'V', 48: 'B', 49: 'N', 50: 'M'
-        }
-    },
-    'QWERTZ': {
-        'key_mapping': {
-            16: 'Q', 17: 'W', 18: 'E', 19: 'R', 20: 'T', 21: 'Z', 22: 'U', 23: 'I', 24: 'O', 25: 'P',
-            30: 'A', 31: 'S', 32: 'D', 33: 'F', 34: 'G', 35: 'H', 36: 'J', 37: 'K', 38: 'L',
-            44: 'Y', 45: 'X', 46: 'C', 47: 'V', 48: 'B', 49: 'N', 50: 'M'
-        }
-    }
-}
+# Bump whenever the rendered output changes for the same inputs, so every manifest entry goes stale
+GENERATOR_VERSION = '1'
+
+# Incremental build manifest, kept in the output directory
+MANIFEST_FILENAME = '.kcm_manifest.json'
+
+# Archive formats for bundle output, by file extension
+ARCHIVE_FORMATS = {'.zip': 'zip', '.tar': 'tar', '.tar.gz': 'tar.gz', '.tgz': 'tar.gz'}
+
+# Timestamp given to archive members unless SOURCE_DATE_EPOCH is set (1980-01-01, the earliest zip allows)
+DEFAULT_ARCHIVE_MTIME = 315532800
+
+# Upper bound on compiled (locale, layout) key tables kept in memory
+KEY_TABLE_CACHE_SIZE = 512
+
+# Layout types in the order they are generated, with their languages.csv column
+LAYOUT_COLUMNS = (
+    ('QWERTY', 'QWERTY_KCM'),
+    ('AZERTY', 'AZERTY_KCM'),
+    ('QWERTZ', 'QWERTZ_KCM'),
+)
 
 # Define row groupings for KCM structure
 ROW_GROUPINGS = {
@@ -34,231 +42,257 @@ ROW_GROUPINGS = {
     'ROW3': [44, 45, 46, 47, 48, 49, 50]
 }
 
-# Language names for header
-LANGUAGE_NAMES = {
-    'zz': 'Alphabet', 'en_US': 'English (US)', 'en_GB': 'English (UK)', 'en_AU': 'English (Australia)',
-    'en_CA': 'English (Canada)', 'en_IE': 'English (Ireland)', 'en_IN': 'English (India)',
-    'en_NZ': 'English (New Zealand)', 'en_SG': 'English (Singapore)', 'en_ZA': 'English (South Africa)',
-    'af': 'Afrikaans', 'az_AZ': 'Azerbaijani', 'bs': 'Bosnian', 'ca': 'Catalan',
-    'cy': 'Welsh', 'da': 'Danish', 'es': 'Spanish', 'es_US': 'Spanish (US)', 'es_MX': 'Spanish (MX)',
-    'es_419': 'Spanish (Latin America)', 'et_EE': 'Estonian', 'eu_ES': 'Basque', 'fi': 'Finnish',
-    'fil': 'Filipino', 'ga': 'Irish', 'gl_ES': 'Galician', 'in': 'Indonesian', 'is': 'Icelandic',
-    'it': 'Italian', 'nb': 'Norwegian Bokmål', 'nl': 'Dutch', 'pl': 'Polish', 'pt_BR': 'Portuguese (Brazil)',
-    'pt_PT': 'Portuguese (Portugal)', 'ro': 'Romanian', 'sq': 'Albanian', 'su': 'Sundanese', 'sv': 'Swedish',
-    'tr': 'Turkish', 'de': 'German', 'at': 'German (Austria)', 'ch-de': 'German (Switzerland)',
-    'cs': 'Czech', 'sk': 'Slovak', 'hu': 'Hungarian', 'hr': 'Croatian', 'sl': 'Slovenian',
-    'sr': 'Serbian', 'fr': 'French', 'fr_CA': 'French (Canada)', 'ja': 'Japanese',
-    'zh_CN_stroke': 'Chinese (Simplified, Stroke)', 'zh_TW_zhuyin': 'Chinese (Traditional, Zhuyin)',
-    'ar': 'Arabic', 'be': 'Belarusian', 'bg': 'Bulgarian', 'ru': 'Russian', 'ru_translit': 'Russian Translit',
-    'uk': 'Ukrainian', 'el': 'Greek', 'iw': 'Hebrew', 'hy_AM': 'Armenian', 'bn_IN': 'Bengali (India)',
-    'hi': 'Hindi', 'kn_IN': 'Kannada', 'ml_IN': 'Malayalam', 'mr_IN': 'Marathi', 'ta_IN': 'Tamil',
-    'te_IN': 'Telugu', 'km_KH': 'Khmer', 'lo_LA': 'Lao', 'th': 'Thai', 'mn_MN': 'Mongolian',
-    'ms_MY': 'Malay', 'ro_translit': 'Romanian Translit', 'vi': 'Vietnamese'
-}
+# Stages a build is timed in, see BuildStats
+BUILD_STAGES = ('csv', 'manifest', 'resolve', 'escape', 'render', 'io')
 
-# Character mappings for non-Latin languages
-CHARACTER_MAPPINGS = {
-    'alt-sym': {
-        'Q': ('0', '~'), 'W': ('1', '`'), 'E': ('2', '['), 'R': ('3', ']'), 'T': ('(', '{'),
-        'Y': (')', '}'), 'U': ('_', '<'), 'I': ('1', '>'), 'O': ('"', '^'), 'P': ('&', '%'),
-        'A': ('#', '_'), 'S': ('4', '+'), 'D': ('5', '-'), 'F': ('6', '='), 'G': ('/', '\\\\'),
-        'H': (':', '|'), 'J': (';', '&'), 'K': ('@', '«'), 'L': (',', '»'),
-        'Z': ('*', '¥'), 'X': ('7', '€'), 'C': ('8', '£'), 'V': ('9', '$'), 'B': ('!', '!'),
-        'N': ('?', '?'), 'M': ('.', '.')
-    },
-    'ru': {  # Russian
-        'Q': ('й', 'Й'), 'W': ('у', 'У'), 'E': ('к', 'К'), 'R': ('е', 'Е'), 'T': ('н', 'Н'),
-        'Y': ('г', 'Г'), 'U': ('ш', 'Ш'), 'I': ('з', 'З'), 'O': ('х', 'Х'), 'P': ('ю', 'Ю'),
-        'A': ('ф', 'Ф'), 'S': ('в', 'В'), 'D': ('а', 'А'), 'F': ('п', 'П'), 'G': ('р', 'Р'),
-        'H': ('о', 'О'), 'J': ('л', 'Л'), 'K': ('д', 'Д'), 'L': ('ж', 'Ж'),
-        'Z': ('я', 'Я'), 'X': ('с', 'С'), 'C': ('м', 'М'), 'V': ('и', 'И'), 'B': ('т', 'Т'),
-        'N': ('ь', 'Ь'), 'M': ('б', 'Б')
-    },
-    'ru_translit': {  # Russian Translit
-        'Q': ('я', 'Я'), 'W': ('ш', 'Ш'), 'E': ('е', 'Е'), 'R': ('р', 'Р'), 'T': ('т', 'Т'),
-        'Y': ('ы', 'Ы'), 'U': ('у', 'У'), 'I': ('и', 'И'), 'O': ('о', 'О'), 'P': ('п', 'П'),
-        'A': ('а', 'А'), 'S': ('с', 'С'), 'D': ('д', 'Д'), 'F': ('ф', 'Ф'), 'G': ('г', 'Г'),
-        'H': ('х', 'Х'), 'J': ('й', 'Й'), 'K': ('к', 'К'), 'L': ('л', 'Л'),
-        'Z': ('з', 'З'), 'X': ('ж', 'Ж'), 'C': ('ц', 'Ц'), 'V': ('в', 'В'), 'B': ('б', 'Б'),
-        'N': ('н', 'Н'), 'M': ("м", "М")
-    },
-    'ar': {  # Arabic
-        'Q': ('ض', 'ض'), 'W': ('ص', 'ص'), 'E': ('ث', 'ث'), 'R': ('ق', 'ق'), 'T': ('ف', 'ف'),
-        'Y': ('غ', 'غ'), 'U': ('ع', 'ع'), 'I': ('ه', 'ه'), 'O': ('خ', 'خ'), 'P': ('ح', 'ح'),
-        'A': ('ش', 'ش'), 'S': ('س', 'س'), 'D': ('ي', 'ي'), 'F': ('ب', 'ب'), 'G': ('ل', 'ل'),
-        'H': ('ا', 'ا'), 'J': ('ت', 'ت'), 'K': ('ن', 'ن'), 'L': ('م', 'م'),
-        'Z': ('ئ', 'ئ'), 'X': ('ء', 'ء'), 'C': ('ؤ', 'ؤ'), 'V': ('ر', 'ر'), 'B': ('لا', 'لا'),
-        'N': ('ى', 'ى'), 'M': ('ة', 'ة')
-    },
-    'ja': {  # Japanese
-        'Q': ('た', 'た'), 'W': ('て', 'て'), 'E': ('い', 'い'), 'R': ('す', 'す'), 'T': ('か', 'か'),
-        'Y': ('ん', 'ん'), 'U': ('な', 'な'), 'I': ('に', 'に'), 'O': ('ら', 'ら'), 'P': ('せ', 'せ'),
-        'A': ('ち', 'ち'), 'S': ('と', 'と'), 'D': ('し', 'し'), 'F': ('は', 'は'), 'G': ('き', 'き'),
-        'H': ('く', 'く'), 'J': ('ま', 'ま'), 'K': ('の', 'の'), 'L': ('り', 'り'),
-        'Z': ('つ', 'つ'), 'X': ('さ', 'さ'), 'C': ('そ', 'そ'), 'V': ('ひ', 'ひ'), 'B': ('こ', 'こ'),
-        'N': ('み', 'み'), 'M': ('も', 'も')
-    },
-    'zh_CN_stroke': {  # Chinese STROKE
-        'Q': ('一', '一'), 'W': ('丨', '丨'), 'E': ('丿', '丿'), 'R': ('丶', '丶'), 'T': ('乙', '乙'),
-        'Y': ('亅', '亅'), 'U': ('二', '二'), 'I': ('八', '八'), 'O': ('冂', '冂'), 'P': ('亠', '亠'),
-        'A': ('人', '人'), 'S': ('儿', '儿'), 'D': ('入', '入'), 'F': ('刀', '刀'), 'G': ('力', '力'),
-        'H': ('勹', '勹'), 'J': ('匕', '匕'), 'K': ('匚', '匚'), 'L': ('十', '十'),
-        'Z': ('口', '口'), 'X': ('囗', '囗'), 'C': ('土', '土'), 'V': ('士', '士'), 'B': ('夂', '夂'),
-        'N': ('夊', '夊'), 'M': ('夕', '夕')
-    },
-    'zh_TW_zhuyin': {  # Zhuyin
-        'Q': ('ㄅ', 'ㄅ'), 'W': ('ㄉ', 'ㄉ'), 'E': ('ˇ', 'ˇ'), 'R': ('ˋ', 'ˋ'), 'T': ('ㄓ', 'ㄓ'),
-        'Y': ('ˊ', 'ˊ'), 'U': ('ㄕ', 'ㄕ'), 'I': ('ㄘ', 'ㄘ'), 'O': ('ㄟ', 'ㄟ'), 'P': ('ㄣ', 'ㄣ'),
-        'A': ('ㄇ', 'ㄇ'), 'S': ('ㄊ', 'ㄊ'), 'D': ('ㄍ', 'ㄍ'), 'F': ('ㄐ', 'ㄐ'), 'G': ('ㄔ', 'ㄔ'),
-        'H': ('ㄗ', 'ㄗ'), 'J': ('ㄧ', 'ㄧ'), 'K': ('ㄛ', 'ㄛ'), 'L': ('ㄨ', 'ㄨ'),
-        'Z': ('ㄈ', 'ㄈ'), 'X': ('ㄌ', 'ㄌ'), 'C': ('ㄎ', 'ㄎ'), 'V': ('ㄑ', 'ㄑ'), 'B': ('ㄒ', 'ㄒ'),
-        'N': ('ㄖ', 'ㄖ'), 'M': ('ㄙ', 'ㄙ')
-    },
-    'be': {  # Belarusian
-        'Q': ('й', 'Й'), 'W': ('ц', 'Ц'), 'E': ('у', 'У'), 'R': ('к', 'К'), 'T': ('е', 'Е'),
-        'Y': ('н', 'Н'), 'U': ('г', 'Г'), 'I': ('ш', 'Ш'), 'O': ('ў', 'Ў'), 'P': ('з', 'З'),
-        'A': ('ф', 'Ф'), 'S': ('ы', 'Ы'), 'D': ('в', 'В'), 'F': ('а', 'А'), 'G': ('п', 'П'),
-        'H': ('р', 'Р'), 'J': ('о', 'О'), 'K': ('л', 'Л'), 'L': ('д', 'Д'),
-        'Z': ('я', 'Я'), 'X': ('ч', 'Ч'), 'C': ('с', 'С'), 'V': ('м', 'М'), 'B': ('і', 'І'),
-        'N': ('т', 'Т'), 'M': ('ь', 'Ь')
-    },
-    'bg': {  # Bulgarian
-        'Q': ('я', 'Я'), 'W': ('в', 'В'), 'E': ('е', 'Е'), 'R': ('р', 'Р'), 'T': ('т', 'Т'),
-        'Y': ('ъ', 'Ъ'), 'U': ('у', 'У'), 'I': ('и', 'И'), 'O': ('о', 'О'), 'P': ('п', 'П'),
-        'A': ('а', 'А'), 'S': ('с', 'С'), 'D': ('д', 'Д'), 'F': ('ф', 'Ф'), 'G': ('г', 'Г'),
-        'H': ('х', 'Х'), 'J': ('й', 'Й'), 'K': ('к', 'К'), 'L': ('л', 'Л'),
-        'Z': ('з', 'З'), 'X': ('ь', 'Ь'), 'C': ('ц', 'Ц'), 'V': ('ж', 'Ж'), 'B': ('б', 'Б'),
-        'N': ('н', 'Н'), 'M': ('м', 'М')
-    },
-    'uk': {  # Ukrainian
-        'Q': ('й', 'Й'), 'W': ('у', 'У'), 'E': ('к', 'К'), 'R': ('е', 'Е'), 'T': ('н', 'Н'),
-        'Y': ('г', 'Г'), 'U': ('ш', 'Ш'), 'I': ('з', 'З'), 'O': ('х', 'Х'), 'P': ('ї', 'Ї'),
-        'A': ('ф', 'Ф'), 'S': ('в', 'В'), 'D': ('а', 'А'), 'F': ('п', 'П'), 'G': ('р', 'Р'),
-        'H': ('о', 'О'), 'J': ('л', 'Л'), 'K': ('д', 'Д'), 'L': ('ж', 'Ж'),
-        'Z': ('я', 'Я'), 'X': ('с', 'С'), 'C': ('м', 'М'), 'V': ('и', 'И'), 'B': ('т', 'Т'),
-        'N': ('ь', 'Ь'), 'M': ('б', 'Б')
-    },
-    'el': {  # Greek
-        'Q': (';', ';'), 'W': ('ς', 'ς'), 'E': ('ε', 'Ε'), 'R': ('ρ', 'Ρ'), 'T': ('τ', 'Τ'),
-        'Y': ('υ', 'Υ'), 'U': ('θ', 'Θ'), 'I': ('ι', 'Ι'), 'O': ('ο', 'Ο'), 'P': ('π', 'Π'),
-        'A': ('α', 'Α'), 'S': ('σ', 'Σ'), 'D': ('δ', 'Δ'), 'F': ('φ', 'Φ'), 'G': ('γ', 'Γ'),
-        'H': ('η', 'Η'), 'J': ('ξ', 'Ξ'), 'K': ('κ', 'Κ'), 'L': ('λ', 'Λ'),
-        'Z': ('ζ', 'Ζ'), 'X': ('χ', 'Χ'), 'C': ('ψ', 'Ψ'), 'V': ('ω', 'Ω'), 'B': ('β', 'Β'),
-        'N': ('ν', 'Ν'), 'M': ('μ', 'Μ')
-    },
-    'iw': {  # Hebrew
-        'Q': ('/', '/'), 'W': ("'", "'"), 'E': ('ק', 'ק'), 'R': ('ר', 'ר'), 'T': ('א', 'א'),
-        'Y': ('ט', 'ט'), 'U': ('ו', 'ו'), 'I': ('ן', 'ן'), 'O': ('ם', 'ם'), 'P': ('פ', 'פ'),
-        'A': ('ש', 'ש'), 'S': ('ד', 'ד'), 'D': ('ג', 'ג'), 'F': ('כ', 'כ'), 'G': ('ע', 'ע'),
-        'H': ('י', 'י'), 'J': ('ח', 'ח'), 'K': ('ל', 'ל'), 'L': ('ך', 'ך'),
-        'Z': ('ז', 'ז'), 'X': ('ס', 'ס'), 'C': ('ב', 'ב'), 'V': ('ה', 'ה'), 'B': ('נ', 'נ'),
-        'N': ('מ', 'מ'), 'M': ('צ', 'צ')
-    },
-    'hy': {  # Armenian
-        'Q': ('ք', 'Ք'), 'W': ('ո', 'Ո'), 'E': ('ե', 'Ե'), 'R': ('ռ', 'Ռ'), 'T': ('տ', 'Տ'),
-        'Y': ('ը', 'Ը'), 'U': ('ւ', 'Ւ'), 'I': ('ի', 'Ի'), 'O': ('օ', 'Օ'), 'P': ('պ', 'Պ'),
-        'A': ('ա', 'Ա'), 'S': ('ս', 'Ս'), 'D': ('դ', 'Դ'), 'F': ('ֆ', 'Ֆ'), 'G': ('գ', 'Գ'),
-        'H': ('հ', 'Հ'), 'J': ('յ', 'Յ'), 'K': ('կ', 'Կ'), 'L': ('լ', 'Լ'),
-        'Z': ('զ', 'Զ'), 'X': ('ղ', 'Ղ'), 'C': ('ց', 'Ց'), 'V': ('վ', 'Վ'), 'B': ('բ', 'Բ'),
-        'N': ('ն', 'Ն'), 'M': ('մ', 'Մ')
-    },
-    'bn': {  # Bengali
-        'Q': ('ৌ', 'ৌ'), 'W': ('ৈ', 'ৈ'), 'E': ('া', 'া'), 'R': ('ী', 'ী'), 'T': ('ূ', 'ূ'),
-        'Y': ('ব', 'ব'), 'U': ('হ', 'হ'), 'I': ('গ', 'গ'), 'O': ('দ', 'দ'), 'P': ('জ', 'জ'),
-        'A': ('ো', 'ো'), 'S': ('ে', 'ে'), 'D': ('ি', 'ি'), 'F': ('ু', 'ু'), 'G': ('প', 'প'),
-        'H': ('র', 'র'), 'J': ('ক', 'ক'), 'K': ('ত', 'ত'), 'L': ('চ', 'চ'),
-        'Z': ('ং', 'ং'), 'X': ('ম', 'ম'), 'C': ('ন', 'ন'), 'V': ('ল', 'ল'), 'B': ('স', 'স'),
-        'N': ('ট', 'ট'), 'M': ('থ', 'থ')
-    },
-    'hi': {  # Hindi (Devanagari)
-        'Q': ('ौ', 'ौ'), 'W': ('ै', 'ै'), 'E': ('ा', 'ा'), 'R': ('ी', 'ी'), 'T': ('ू', 'ू'),
-        'Y': ('ब', 'ब'), 'U': ('ह', 'ह'), 'I': ('ग', 'ग'), 'O': ('द', 'द'), 'P': ('ज', 'ज'),
-        'A': ('ो', 'ो'), 'S': ('े', 'े'), 'D': ('ि', 'ि'), 'F': ('ु', 'ु'), 'G': ('प', 'प'),
-        'H': ('र', 'र'), 'J': ('क', 'क'), 'K': ('त', 'त'), 'L': ('च', 'च'),
-        'Z': ('़', '़'), 'X': ('म', 'म'), 'C': ('न', 'न'), 'V': ('ल', 'ल'), 'B': ('स', 'स'),
-        'N': ('ट', 'ट'), 'M': ('थ', 'थ')
-    },
-    'kn': {  # Kannada
-        'Q': ('ೌ', 'ೌ'), 'W': ('ೆ', 'ೆ'), 'E': ('ಾ', 'ಾ'), 'R': ('ೀ', 'ೀ'), 'T': ('ೂ', 'ೂ'),
-        'Y': ('ಬ', 'ಬ'), 'U': ('ಹ', 'ಹ'), 'I': ('ಗ', 'ಗ'), 'O': ('ದ', 'ದ'), 'P': ('ಜ', 'ಜ'),
-        'A': ('ೊ', 'ೊ'), 'S': ('ೇ', 'ೇ'), 'D': ('ಿ', 'ಿ'), 'F': ('ು', 'ು'), 'G': ('ಪ', 'ಪ'),
-        'H': ('ರ', 'ರ'), 'J': ('ಕ', 'ಕ'), 'K': ('ತ', 'ತ'), 'L': ('ಚ', 'ಚ'),
-        'Z': ('ಃ', 'ಃ'), 'X': ('ಮ', 'ಮ'), 'C': ('ನ', 'ನ'), 'V': ('ಲ', 'ಲ'), 'B': ('ಸ', 'ಸ'),
-        'N': ('ಟ', 'ಟ'), 'M': ('ಥ', 'ಥ')
-    },
-    'ml': {  # Malayalam
-        'Q': ('ൌ', 'ൌ'), 'W': ('ൈ', 'ൈ'), 'E': ('ാ', 'ാ'), 'R': ('ീ', 'ീ'), 'T': ('ൂ', 'ൂ'),
-        'Y': ('ബ', 'ബ'), 'U': ('ഹ', 'ഹ'), 'I': ('ഗ', 'ഗ'), 'O': ('ദ', 'ദ'), 'P': ('ജ', 'ജ'),
-        'A': ('ോ', 'ോ'), 'S': ('േ', 'േ'), 'D': ('ി', 'ി'), 'F': ('ു', 'ു'), 'G': ('പ', 'പ'),
-        'H': ('ര', 'ര'), 'J': ('ക', 'ക'), 'K': ('ത', 'ത'), 'L': ('ച', 'ച'),
-        'Z': ('ഃ', 'ഃ'), 'X': ('മ', 'മ'), 'C': ('ന', 'ന'), 'V': ('ല', 'ല'), 'B': ('സ', 'സ'),
-        'N': ('ട', 'ട'), 'M': ('ഥ', 'ഥ')
-    },
-    'mr': {  # Marathi
-        'Q': ('ौ', 'ौ'), 'W': ('ै', 'ै'), 'E': ('ा', 'ा'), 'R': ('ी', 'ी'), 'T': ('ू', 'ू'),
-        'Y': ('ब', 'ब'), 'U': ('ह', 'ह'), 'I': ('ग', 'ग'), 'O': ('द', 'द'), 'P': ('ज', 'ज'),
-        'A': ('ो', 'ो'), 'S': ('े', 'े'), 'D': ('ि', 'ि'), 'F': ('ु', 'ु'), 'G': ('प', 'प'),
-        'H': ('र', 'र'), 'J': ('क', 'क'), 'K': ('त', 'त'), 'L': ('च', 'च'),
-        'Z': ('़', '़'), 'X': ('म', 'म'), 'C': ('न', 'न'), 'V': ('ल', 'ल'), 'B': ('स', 'स'),
-        'N': ('ट', 'ट'), 'M': ('थ', 'थ')
-    },
-    'ta': {  # Tamil
-        'Q': ('ஔ', 'ஔ'), 'W': ('ஐ', 'ஐ'), 'E': ('ஆ', 'ஆ'), 'R': ('ஈ', 'ஈ'), 'T': ('ஊ', 'ஊ'),
-        'Y': ('ப', 'ப'), 'U': ('ஹ', 'ஹ'), 'I': ('க', 'க'), 'O': ('த', 'த'), 'P': ('ஜ', 'ஜ'),
-        'A': ('ஓ', 'ஓ'), 'S': ('ஏ', 'ஏ'), 'D': ('இ', 'இ'), 'F': ('உ', 'உ'), 'G': ('ஞ', 'ஞ'),
-        'H': ('ர', 'ர'), 'J': ('ா', 'ா'), 'K': ('ட', 'ட'), 'L': ('ச', 'ச'),
-        'Z': ('ஃ', 'ஃ'), 'X': ('ம', 'ம'), 'C': ('ன', 'ன'), 'V': ('ல', 'ல'), 'B': ('ஸ', 'ஸ'),
-        'N': ('ண', 'ண'), 'M': ('ந', 'ந')
-    },
-    'te': {  # Telugu
-        'Q': ('ౌ', 'ౌ'), 'W': ('ై', 'ై'), 'E': ('ా', 'ా'), 'R': ('ీ', 'ీ'), 'T': ('ూ', 'ూ'),
-        'Y': ('బ', 'బ'), 'U': ('హ', 'హ'), 'I': ('గ', 'గ'), 'O': ('ద', 'ద'), 'P': ('జ', 'జ'),
-        'A': ('ో', 'ో'), 'S': ('ే', 'ే'), 'D': ('ి', 'ి'), 'F': ('ు', 'ు'), 'G': ('ప', 'ప'),
-        'H': ('ర', 'ర'), 'J': ('క', 'క'), 'K': ('త', 'త'), 'L': ('చ', 'చ'),
-        'Z': ('ః', 'ః'), 'X': ('మ', 'మ'), 'C': ('న', 'న'), 'V': ('ల', 'ల'), 'B': ('స', 'స'),
-        'N': ('ట', 'ట'), 'M': ('థ', 'థ')
-    },
-    'km': {  # Khmer
-        'Q': ('ឝ', 'ឝ'), 'W': ('ឞ', 'ឞ'), 'E': ('េ', 'េ'), 'R': ('ៀ', 'ៀ'), 'T': ('ំ', 'ំ'),
-        'Y': ('ប', 'ប'), 'U': ('ហ', 'ហ'), 'I': ('ក', 'ក'), 'O': ('ដ', 'ដ'), 'P': ('ព', 'ព'),
-        'A': ('ា', 'ា'), 'S': ('ស', 'ស'), 'D': ('ឌ', 'ឌ'), 'F': ('ថ', 'ថ'), 'G': ('ភ', 'ភ'),
-        'H': ('រ', 'រ'), 'J': ('យ', 'យ'), 'K': ('ឡ', 'ឡ'), 'L': ('ល', 'ល'),
-        'Z': ('ឆ', 'ឆ'), 'X': ('ខ', 'ខ'), 'C': ('ឈ', 'ឈ'), 'V': ('វ', 'វ'), 'B': ('អ', 'អ'),
-        'N': ('ន', 'ន'), 'M': ('ម', 'ម')
-    },
-    'lo': {  # Lao
-        'Q': ('ເ', 'ເ'), 'W': ('ແ', 'ແ'), 'E': ('ໍ', 'ໍ'), 'R': ('ຽ', 'ຽ'), 'T': ('໌', '໌'),
-        'Y': ('ບ', 'ບ'), 'U': ('ຮ', 'ຮ'), 'I': ('ງ', 'ງ'), 'O': ('ດ', 'ດ'), 'P': ('ຈ', 'ຈ'),
-        'A': ('າ', 'າ'), 'S': ('ສ', 'ສ'), 'D': ('ຄ', 'ຄ'), 'F': ('ຕ', 'ຕ'), 'G': ('ຜ', 'ຜ'),
-        'H': ('ຣ', 'ຣ'), 'J': ('ຢ', 'ຢ'), 'K': ('ລ', 'ລ'), 'L': ('ວ', 'ວ'),
-        'Z': ('ຊ', 'ຊ'), 'X': ('ຂ', 'ຂ'), 'C': ('ໜ', 'ໜ'), 'V': ('ໝ', 'ໝ'), 'B': ('ຫ', 'ຫ'),
-        'N': ('ນ', 'ນ'), 'M': ('ມ', 'ມ')
-    },
-    'th': {  # Thai
-        'Q': ('ๆ', 'ๆ'), 'W': ('ไ', 'ไ'), 'E': ('ำ', 'ำ'), 'R': ('พ', 'พ'), 'T': ('ะ', 'ะ'),
-        'Y': ('ั', 'ั'), 'U': ('ี', 'ี'), 'I': ('ร', 'ร'), 'O': ('น', 'น'), 'P': ('ย', 'ย'),
-        'A': ('ฟ', 'ฟ'), 'S': ('ห', 'ห'), 'D': ('ก', 'ก'), 'F': ('ด', 'ด'), 'G': ('เ', 'เ'),
-        'H': ('้', '้'), 'J': ('่', '่'), 'K': ('า', 'า'), 'L': ('ส', 'ส'),
-        'Z': ('ผ', 'ผ'), 'X': ('ป', 'ป'), 'C': ('แ', 'แ'), 'V': ('อ', 'อ'), 'B': ('ิ', 'ิ'),
-        'N': ('ื', 'ื'), 'M': ('ท', 'ท')
-    },
-    'mn': {  # Mongolian (Cyrillic)
-        'Q': ('й', 'Й'), 'W': ('ц', 'Ц'), 'E': ('у', 'У'), 'R': ('к', 'К'), 'T': ('е', 'Е'),
-        'Y': ('н', 'Н'), 'U': ('г', 'Г'), 'I': ('ш', 'Ш'), 'O': ('ө', 'Ө'), 'P': ('з', 'З'),
-        'A': ('ф', 'Ф'), 'S': ('ы', 'Ы'), 'D': ('в', 'В'), 'F': ('а', 'А'), 'G': ('п', 'П'),
-        'H': ('р', 'Р'), 'J': ('о', 'О'), 'K': ('л', 'Л'), 'L': ('д', 'Д'),
-        'Z': ('я', 'Я'), 'X': ('ч', 'Ч'), 'C': ('с', 'С'), 'V': ('м', 'М'), 'B': ('и', 'И'),
-        'N': ('т', 'Т'), 'M': ('ь', 'Ь')
-    },
-    'ro_translit': {  # Romanian Translit
-        'Q': ('â', 'Â'), 'W': ('w', 'W'), 'E': ('e', 'E'), 'R': ('r', 'R'), 'T': ('t', 'T'),
-        'Y': ('y', 'Y'), 'U': ('u', 'U'), 'I': ('i', 'I'), 'O': ('o', 'O'), 'P': ('p', 'P'),
-        'A': ('a', 'A'), 'S': ('s', 'S'), 'D': ('d', 'D'), 'F': ('f', 'F'), 'G': ('g', 'G'),
-        'H': ('h', 'H'), 'J': ('j', 'J'), 'K': ('k', 'K'), 'L': ('l', 'L'),
-        'Z': ('z', 'Z'), 'X': ('x', 'X'), 'C': ('c', 'C'), 'V': ('v', 'V'), 'B': ('b', 'B'),
-        'N': ('n', 'N'), 'M': ('m', 'M')
+class _StageTimer(object):
+    # One timed stage. Time spent in a nested stage is charged to that stage only,
+    # so the stage totals add up to the instrumented part of the run.
+    __slots__ = ('stats', 'name', 'start')
+    
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    
+    def __enter__(self):
+        now = time.perf_counter()
+        stack = self.stats._stack
+        if stack:
+            parent = stack[-1]
+            self.stats.seconds[parent.name] += now - parent.start
+        stack.append(self)
+        self.start = now
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        now = time.perf_counter()
+        stats = self.stats
+        stats._stack.pop()
+        stats.seconds[self.name] += now - self.start
+        stats.calls[self.name] += 1
+        if stats._stack:
+            stats._stack[-1].start = now
+
+class _NullStage(object):
+    __slots__ = ()
+    
+    def __enter__(self):
+        pass
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class BuildStats(object):
+    # Per-stage timings, counters and per-file byte counts for one build. Disabled
+    # by default, in which case stage() and count() cost a single attribute check.
+    # Worker processes gather their own and hand a snapshot() back to be merge()d.
+    
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+    
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.files = {}
+        self._stack = []
+    
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _StageTimer(self, name)
+    
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+    
+    def add_file(self, name, size):
+        if self.enabled:
+            self.files[name] = size
+    
+    def snapshot(self):
+        return {
+            'seconds': dict(self.seconds),
+            'calls': dict(self.calls),
+            'counters': dict(self.counters),
+            'files': dict(self.files),
+        }
+    
+    def merge(self, snapshot):
+        for name, seconds in snapshot['seconds'].items():
+            self.seconds[name] += seconds
+        for name, calls in snapshot['calls'].items():
+            self.calls[name] += calls
+        for name, amount in snapshot['counters'].items():
+            self.counters[name] += amount
+        self.files.update(snapshot['files'])
+    
+    def report(self, total_seconds, counters=None):
+        # JSON-ready summary; counters (e.g. cache_counters()) are added to the gathered ones.
+        # With worker processes, stage seconds are summed over all of them and can exceed the total.
+        merged = defaultdict(int, self.counters)
+        for name, amount in (counters or {}).items():
+            merged[name] += amount
+        stages = {
+            name: {'seconds': self.seconds[name], 'calls': self.calls[name]}
+            for name in sorted(set(BUILD_STAGES) | set(self.seconds))
+        }
+        return {
+            'total_seconds': total_seconds,
+            'stages': stages,
+            'counters': dict(sorted(merged.items())),
+            'files': dict(sorted(self.files.items())),
+            'files_written': len(self.files),
+            'bytes_written': sum(self.files.values()),
+        }
+
+# Build statistics for this process, enabled by --stats
+STATS = BuildStats()
+
+# Data files: physical layouts, header names, and one character mapping file per language
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Precompiled copies of the data files, keyed by interpreter, DATA_CACHE_VERSION and source hash
+DATA_CACHE_DIR = os.path.join(DATA_DIR, '__cache__')
+
+# Bump whenever a data file's convert function or the shape it returns changes, so cached copies go stale
+DATA_CACHE_VERSION = '1'
+
+def load_data_file(path, convert):
+    # Load a JSON data file as convert(json), going through the precompiled marshal cache.
+    # Only the source hash is computed on a cache hit, the JSON itself is never parsed.
+    with open(path, 'rb') as f:
+        source = f.read()
+    
+    # Everything up to the version is shared by all cached copies of this file, which
+    # lets a new one replace copies from older versions as well as older sources
+    cache_prefix = '{}.{}.'.format(
+        os.path.relpath(path, DATA_DIR)[:-len('.json')].replace(os.sep, '-'),
+        sys.implementation.cache_tag
+    )
+    cache_path = os.path.join(DATA_CACHE_DIR, '{}v{}.{}.marshal'.format(
+        cache_prefix, DATA_CACHE_VERSION, hashlib.sha256(source).hexdigest()[:16]
+    ))
+    try:
+        with open(cache_path, 'rb') as f:
+            data = marshal.load(f)
+        STATS.count('data_cache.hits')
+        return data
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    
+    STATS.count('data_cache.misses')
+    data = convert(json.loads(source.decode('utf-8')))
+    
+    # The cache is best effort, a read-only checkout just parses the JSON every time
+    try:
+        os.makedirs(DATA_CACHE_DIR, exist_ok=True)
+        for name in os.listdir(DATA_CACHE_DIR):
+            if name.startswith(cache_prefix):
+                os.unlink(os.path.join(DATA_CACHE_DIR, name))
+        write_atomic(cache_path, marshal.dumps(data))
+    except OSError:
+        pass
+    
+    return data
+
+class DataFile(Mapping):
+    # Read-only dict backed by a single data file, loaded on first access
+    
+    def __init__(self, path, convert):
+        self.path = path
+        self.convert = convert
+        self._data = None
+    
+    def _load(self):
+        if self._data is None:
+            self._data = load_data_file(self.path, self.convert)
+        return self._data
+    
+    def __getitem__(self, key):
+        return self._load()[key]
+    
+    def __iter__(self):
+        return iter(self._load())
+    
+    def __len__(self):
+        return len(self._load())
+    
+    def reload(self):
+        self._data = None
+
+class DataDirectory(Mapping):
+    # Read-only dict with one data file per entry, each loaded the first time it is looked up.
+    # Membership tests only list the directory, so probing for a locale loads nothing.
+    
+    def __init__(self, path, convert):
+        self.path = path
+        self.convert = convert
+        self._names = None
+        self._entries = {}
+    
+    def _listing(self):
+        if self._names is None:
+            self._names = frozenset(name[:-len('.json')] for name in os.listdir(self.path) if name.endswith('.json'))
+        return self._names
+    
+    def source_path(self, name):
+        return os.path.join(self.path, name + '.json')
+    
+    def __contains__(self, name):
+        return name in self._listing()
+    
+    def __getitem__(self, name):
+        try:
+            return self._entries[name]
+        except KeyError:
+            pass
+        if name not in self._listing():
+            raise KeyError(name)
+        entry = self._entries[name] = load_data_file(self.source_path(name), self.convert)
+        return entry
+    
+    def __iter__(self):
+        return iter(sorted(self._listing()))
+    
+    def __len__(self):
+        return len(self._listing())
+    
+    def reload(self, names=None):
+        # Forget loaded entries (only names, if given) and re-list the directory
+        self._names = None
+        if names is None:
+            self._entries.clear()
+        else:
+            for name in names:
+                self._entries.pop(name, None)
+
+# Define physical layouts
+PHYSICAL_LAYOUTS = DataFile(
+    os.path.join(DATA_DIR, 'physical_layouts.json'),
+    lambda layouts: {
+        layout_type: {'key_mapping': {int(key_code): label for key_code, label in layout['key_mapping'].items()}}
+        for layout_type, layout in layouts.items()
     }
-}
+)
+
+# Language names for header
+LANGUAGE_NAMES = DataFile(os.path.join(DATA_DIR, 'language_names.json'), dict)
+
+# Character mappings for non-Latin languages, plus the shared 'alt-sym' table
+CHARACTER_MAPPINGS = DataDirectory(
+    os.path.join(DATA_DIR, 'mappings'),
+    lambda mapping: {label: tuple(chars) for label, chars in mapping['keys'].items()}
+)
+
+def reload_data(mapping_names=None):
+    # Re-read the data files after they change on disk, only the given mappings if mapping_names is set
+    PHYSICAL_LAYOUTS.reload()
+    LANGUAGE_NAMES.reload()
+    CHARACTER_MAPPINGS.reload(mapping_names)
+    invalidate_key_tables()
 
 def unicode_escape(s):
     return ''.join(
@@ -266,107 +300,1234 @@ def unicode_escape(s):
         for c in s
     )
 
-def generate_kcm_file(locale, layout_type, kcm_filename, output_dir):
-    # Get physical layout mapping, we assume base hardware layout is set to QWERTY in the system by QPNP keypad
-    base_layout = PHYSICAL_LAYOUTS["QWERTY"]
-    physical_layout = PHYSICAL_LAYOUTS[layout_type]
+# What the KCM tokenizer accepts after a backslash in a character literal, besides \uXXXX
+KCM_ESCAPES = {'n': '\n', 't': '\t', '0': '\0', '\\': '\\', "'": "'", '"': '"'}
+
+def decode_kcm_literal(text):
+    # Decode the text between the quotes of a KCM character literal to the single
+    # character it stands for, raising ValueError where Android's parser would fail
+    if not text:
+        raise ValueError("empty character literal")
+    if text[0] == '\\':
+        if text[1:2] == 'u':
+            digits = text[2:6]
+            if len(digits) != 4 or not all(c in '0123456789abcdefABCDEF' for c in digits):
+                raise ValueError("malformed \\u escape")
+            char, rest = chr(int(digits, 16)), text[6:]
+        elif text[1:2] in KCM_ESCAPES:
+            char, rest = KCM_ESCAPES[text[1]], text[2:]
+        else:
+            raise ValueError("invalid escape {!r}".format(text[:2]))
+    elif text[0] == "'":
+        raise ValueError("unescaped quote")
+    elif ord(text[0]) < 32 or ord(text[0]) == 127:
+        raise ValueError("control character")
+    else:
+        char, rest = text[0], text[1:]
+    if rest:
+        raise ValueError("more than one character")
+    return char
+
+@functools.lru_cache(maxsize=KEY_TABLE_CACHE_SIZE)
+def resolve_mapping_chain(locale):
+    # Mappings to try for a locale, full locale first, then its language (ru_translit -> ru, hy_AM -> hy)
+    chain = []
+    for candidate in (locale, locale.split('_')[0]):
+        if candidate in CHARACTER_MAPPINGS and candidate not in chain:
+            chain.append(candidate)
+    return tuple(chain)
+
+class KeyRecord(object):
+    # One key of a layout: its scancode, the QWERTY label the KCM file knows it by,
+    # and the unescaped characters it produces. Immutable, since compile_layout shares
+    # one record between every layout with the same key and interns it by value.
+    __slots__ = ('scancode', 'label', 'base', 'shift', 'alt', 'sym')
     
-    # Get language name for header
-    language_name = LANGUAGE_NAMES.get(locale, locale)
+    def __init__(self, scancode, label, base, shift, alt, sym):
+        set_field = object.__setattr__
+        set_field(self, 'scancode', scancode)
+        set_field(self, 'label', label)
+        set_field(self, 'base', base)
+        set_field(self, 'shift', shift)
+        set_field(self, 'alt', alt)
+        set_field(self, 'sym', sym)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("KeyRecord is immutable")
+    
+    def __delattr__(self, name):
+        raise AttributeError("KeyRecord is immutable")
+    
+    def __reduce__(self):
+        # The default slot state restore would go through __setattr__
+        return (KeyRecord, self.astuple())
+    
+    def astuple(self):
+        return (self.scancode, self.label, self.base, self.shift, self.alt, self.sym)
     
-    # Create KCM content with proper header
-    content = "#\n"
-    content += "# {} for reduced physical keyboard\n".format(language_name)
-    content += "# Gor Mirzoyan (xwtk.cloud).\n"
-    content += "#\n\n"
-    content += "type OVERLAY\n\n"
+    def __eq__(self, other):
+        if not isinstance(other, KeyRecord):
+            return NotImplemented
+        return self.astuple() == other.astuple()
     
-    # Process each row group
+    def __hash__(self):
+        return hash(self.astuple())
+    
+    def __repr__(self):
+        return 'KeyRecord({!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(*self.astuple())
+
+class KeyLayout(object):
+    # Fixed-length sequence of KeyRecords for one (locale, layout_type) in row order.
+    # rows holds a (row_name, start, end) slice per row and is shared by every
+    # layout of the same physical layout.
+    __slots__ = ('locale', 'layout_type', 'keys', 'rows')
+    
+    def __init__(self, locale, layout_type, keys, rows):
+        self.locale = locale
+        self.layout_type = layout_type
+        self.keys = keys
+        self.rows = rows
+    
+    def __iter__(self):
+        return iter(self.keys)
+    
+    def __len__(self):
+        return len(self.keys)
+    
+    def __getitem__(self, index):
+        return self.keys[index]
+    
+    def iter_rows(self):
+        for row_name, start, end in self.rows:
+            yield row_name, self.keys[start:end]
+    
+    def __repr__(self):
+        return '<KeyLayout {} {} ({} keys)>'.format(self.locale, self.layout_type, len(self.keys))
+
+@functools.lru_cache(maxsize=None)
+def scancode_labels(layout_type):
+    # Physical layout as a tuple indexed by scancode, None where the layout has no key
+    key_mapping = PHYSICAL_LAYOUTS[layout_type]['key_mapping']
+    labels = [None] * (max(max(key_codes) for key_codes in ROW_GROUPINGS.values()) + 1)
+    for key_code, label in key_mapping.items():
+        if key_code < len(labels):
+            labels[key_code] = label
+    return tuple(labels)
+
+@functools.lru_cache(maxsize=None)
+def layout_rows(layout_type):
+    # (row_name, start, end) slices of a KeyLayout's keys for this physical layout
+    labels = scancode_labels(layout_type)
+    rows = []
+    start = 0
     for row_name, key_codes in ROW_GROUPINGS.items():
-        content += "### {}\n".format(row_name)
+        end = start + sum(1 for key_code in key_codes if labels[key_code] is not None)
+        rows.append((row_name, start, end))
+        start = end
+    return tuple(rows)
+
+# Every distinct KeyRecord and keys tuple built by compile_layout, so layouts that
+# agree on a key (e.g. the Latin fallback keys) or on every key share one object
+_INTERNED_KEYS = {}
+
+def intern_keys(value):
+    return _INTERNED_KEYS.setdefault(value, value)
+
+@functools.lru_cache(maxsize=KEY_TABLE_CACHE_SIZE)
+def compile_layout(locale, layout_type):
+    with STATS.stage('resolve'):
+        # Get physical layout mapping, we assume base hardware layout is set to QWERTY in the system by QPNP keypad
+        base_labels = scancode_labels("QWERTY")
+        labels = scancode_labels(layout_type)
+        mappings = [CHARACTER_MAPPINGS[name] for name in resolve_mapping_chain(locale)]
+        alt_sym = CHARACTER_MAPPINGS["alt-sym"]
         
-        for key_code in key_codes:
-            if key_code not in physical_layout['key_mapping']:
-                continue
+        keys = []
+        for key_codes in ROW_GROUPINGS.values():
+            for key_code in key_codes:
+                key_label = labels[key_code]
+                if key_label is None:
+                    continue
                 
-            base_key_label = base_layout['key_mapping'][key_code]
-            key_label = physical_layout['key_mapping'][key_code]
-            
-            # Get character mapping, prioritize full locale
-            if locale in CHARACTER_MAPPINGS and key_label in CHARACTER_MAPPINGS[locale]:
-                base_char, shift_char = CHARACTER_MAPPINGS[locale][key_label]
-                alt, sym = CHARACTER_MAPPINGS["alt-sym"][key_label]
-            elif locale.split('_')[0] in CHARACTER_MAPPINGS and key_label in CHARACTER_MAPPINGS[locale.split('_')[0]]:
-                base_char, shift_char = CHARACTER_MAPPINGS[locale.split('_')[0]][key_label]
-                alt, sym = CHARACTER_MAPPINGS["alt-sym"][key_label]
-            else:
-                # Default to Latin mapping
-                base_char = key_label.lower()
-                shift_char = key_label.upper()
-                alt, sym = CHARACTER_MAPPINGS["alt-sym"][key_label]
-            
-            # Apply Unicode escaping to non-ASCII characters
-            escaped_base = unicode_escape(base_char)
-            escaped_shift = unicode_escape(shift_char)
-            
-            escaped_alt = unicode_escape(alt)
-            escaped_sym = unicode_escape(sym)
-            
-            # Create key entry
-            content += "key {} {{\n".format(base_key_label)
-            content += "    label: '{}'\n".format(base_key_label)
-            content += "    base: '{}'\n".format(escaped_base)
-            content += "    shift, capslock: '{}'\n".format(escaped_shift)
-            content += "    lalt, alt: '{}'\n".format(escaped_alt)
-            content += "    sym: '{}'\n".format(escaped_sym)
-            content += "}\n\n"
-    
-    # Write to file
+                # Get character mapping, prioritize full locale
+                for mapping in mappings:
+                    if key_label in mapping:
+                        base_char, shift_char = mapping[key_label]
+                        break
+                else:
+                    # Default to Latin mapping
+                    base_char = key_label.lower()
+                    shift_char = key_label.upper()
+                alt, sym = alt_sym[key_label]
+                
+                keys.append(intern_keys(KeyRecord(key_code, base_labels[key_code], base_char, shift_char, alt, sym)))
+        
+        return KeyLayout(locale, layout_type, intern_keys(tuple(keys)), layout_rows(layout_type))
+
+def cache_counters():
+    # Hit and miss counts of the in-memory compile caches, as BuildStats counters
+    counters = {}
+    for func in (resolve_mapping_chain, scancode_labels, layout_rows, compile_layout):
+        info = func.cache_info()
+        counters[func.__name__ + '.hits'] = info.hits
+        counters[func.__name__ + '.misses'] = info.misses
+    counters['escape.misses'] = len(ESCAPED_VALUES)
+    return counters
+
+def invalidate_key_tables():
+    # Must be called whenever PHYSICAL_LAYOUTS, ROW_GROUPINGS or CHARACTER_MAPPINGS change
+    resolve_mapping_chain.cache_clear()
+    scancode_labels.cache_clear()
+    layout_rows.cache_clear()
+    compile_layout.cache_clear()
+    _INTERNED_KEYS.clear()
+    ESCAPED_VALUES.clear()
+
+# KCM header, followed by one KEY_TEMPLATE block per key under a "### ROWn" line
+KCM_HEADER = (
+    "#\n"
+    "# {} for reduced physical keyboard\n"
+    "# Gor Mirzoyan (xwtk.cloud).\n"
+    "#\n\n"
+    "type OVERLAY\n\n"
+)
+# %-style since it is filled in once per key, where it is about twice as fast as str.format
+KEY_TEMPLATE = (
+    "key %s {\n"
+    "    label: '%s'\n"
+    "    base: '%s'\n"
+    "    shift, capslock: '%s'\n"
+    "    lalt, alt: '%s'\n"
+    "    sym: '%s'\n"
+    "}\n\n"
+)
+
+class EscapeTable(dict):
+    # unicode_escape(value) for every mapping value seen so far, filled in on lookup.
+    # The mappings only hold a few hundred distinct characters.
+    
+    def __missing__(self, value):
+        with STATS.stage('escape'):
+            escaped = self[value] = unicode_escape(value)
+        return escaped
+
+ESCAPED_VALUES = EscapeTable()
+
+def render_kcm(locale, layout_type):
+    # Yields the KCM file as text chunks: the header, then a row heading or a key block per chunk
+    layout = compile_layout(locale, layout_type)
+    
+    # Get language name for header
+    language_name = LANGUAGE_NAMES.get(locale, locale)
+    yield KCM_HEADER.format(language_name)
+    
+    escaped = ESCAPED_VALUES
+    for row_name, keys in layout.iter_rows():
+        yield "### {}\n".format(row_name)
+        for key in keys:
+            yield KEY_TEMPLATE % (
+                key.label, key.label, escaped[key.base], escaped[key.shift], escaped[key.alt], escaped[key.sym]
+            )
+
+class KcmSink(object):
+    # Destination for one rendered KCM file. Chunks are collected as text and
+    # encoded to UTF-8 in a single pass on close(), then handed to commit().
+    # Used as a context manager, a sink is discarded if rendering raises.
+    
+    def __init__(self):
+        self._chunks = []
+        self.closed = False
+    
+    def write(self, chunk):
+        self._chunks.append(chunk)
+    
+    def writelines(self, chunks):
+        self._chunks.extend(chunks)
+    
+    def close(self):
+        # Returns the number of bytes committed
+        data = ''.join(self._chunks).encode('utf-8')
+        self._chunks = []
+        self.closed = True
+        self.commit(data)
+        return len(data)
+    
+    def commit(self, data):
+        raise NotImplementedError
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            if not self.closed:
+                self.close()
+        else:
+            self._chunks = []
+            self.closed = True
+
+class BufferSink(KcmSink):
+    # Keeps the encoded file in memory
+    
+    def __init__(self):
+        super().__init__()
+        self.data = b''
+    
+    def commit(self, data):
+        self.data = data
+    
+    def getvalue(self):
+        return self.data
+
+class FileSink(KcmSink):
+    # Writes the encoded file atomically to path
+    
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+    
+    def commit(self, data):
+        write_atomic(self.path, data)
+
+class StreamSink(KcmSink):
+    # Writes the encoded file to an open binary stream, e.g. sys.stdout.buffer
+    
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+    
+    def commit(self, data):
+        self.stream.write(data)
+
+def render_kcm_to(sink, locale, layout_type):
+    # Render one layout into sink and close it, returns the number of bytes written
+    with STATS.stage('render'), sink:
+        sink.writelines(render_kcm(locale, layout_type))
+        return sink.close()
+
+def generate_kcm_file(locale, layout_type, kcm_filename, output_dir):
     os.makedirs(output_dir, exist_ok=True)
     output_path = os.path.join(output_dir, kcm_filename)
     
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    STATS.add_file(kcm_filename, render_kcm_to(FileSink(output_path), locale, layout_type))
     
     return output_path
 
-def main(language_list_file, output_dir):
-    # Read language list CSV
-    with open(language_list_file, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        languages = list(reader)
+# KCM property names mapped to the KeyRecord field they set
+KCM_PROPERTIES = {
+    'base': 'base',
+    'shift': 'shift', 'capslock': 'shift',
+    'alt': 'alt', 'lalt': 'alt', 'ralt': 'alt',
+    'sym': 'sym',
+}
+
+KCM_KEY_RE = re.compile(r"^key\s+(\w+)\s*\{$")
+KCM_PROPERTY_RE = re.compile(r"^([\w+]+(?:\s*,\s*[\w+]+)*)\s*:\s*(.*?)$")
+KCM_UNICODE_ESCAPE_RE = re.compile(r"\\(u[0-9a-fA-F]{4}|.)")
+# A quoted character behavior, optionally followed by a comment. ''' is accepted as a
+# quote since that is what a bare ' in a mapping renders to (--validate flags it)
+KCM_CHARACTER_RE = re.compile(r"^'((?:[^'\\]|\\.)*|')'\s*(?:#.*)?$")
+
+def unescape_unicode(text):
+    # Inverse of unicode_escape: expand \uXXXX but keep other escapes as written,
+    # which is the form mapping values use (e.g. '\\\\' for a backslash)
+    return KCM_UNICODE_ESCAPE_RE.sub(
+        lambda match: chr(int(match.group(1)[1:], 16)) if len(match.group(1)) == 5 else match.group(0),
+        text
+    )
+
+def iter_kcm(lines):
+    # Stream (row_name, KeyRecord) pairs out of the KCM dialect render_kcm writes,
+    # reading lines lazily so large files and file objects are never held whole.
+    # "### ROWn" comments name the rows; keys missing a property get None for it.
+    base_labels = scancode_labels("QWERTY")
+    scancodes = {label: key_code for key_code, label in enumerate(base_labels) if label is not None}
+    row_name = ''
+    fields = None
+    
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            if line.startswith('### '):
+                row_name = line[4:].strip()
+            continue
+        
+        if fields is None:
+            match = KCM_KEY_RE.match(line)
+            if match:
+                label = match.group(1)
+                fields = {'scancode': scancodes.get(label), 'label': label}
+            elif not line.startswith('type '):
+                raise ValueError("line {}: expected a key block, got {!r}".format(line_number, line))
+            continue
+        
+        if line == '}':
+            yield row_name, KeyRecord(
+                fields['scancode'], fields['label'],
+                fields.get('base'), fields.get('shift'), fields.get('alt'), fields.get('sym')
+            )
+            fields = None
+            continue
+        
+        match = KCM_PROPERTY_RE.match(line)
+        if not match:
+            raise ValueError("line {}: malformed property {!r}".format(line_number, line))
+        behavior = match.group(2)
+        if not behavior.startswith("'"):
+            # none, fallback and other non-character behaviors have no place in the model
+            continue
+        character = KCM_CHARACTER_RE.match(behavior)
+        if not character:
+            raise ValueError("line {}: malformed character literal {!r}".format(line_number, behavior))
+        value = unescape_unicode(character.group(1))
+        for name in match.group(1).split(','):
+            field = KCM_PROPERTIES.get(name.strip())
+            if field is not None:
+                fields[field] = value
+    
+    if fields is not None:
+        raise ValueError("unterminated key block for {}".format(fields['label']))
+
+def parse_kcm(lines, locale=None, layout_type=None):
+    # Parse a KCM file (any iterable of lines) into a KeyLayout
+    keys = []
+    rows = []
+    for row_name, key in iter_kcm(lines):
+        if not rows or rows[-1][0] != row_name:
+            rows.append([row_name, len(keys), len(keys)])
+        keys.append(key)
+        rows[-1][2] = len(keys)
+    return KeyLayout(locale, layout_type, tuple(keys), tuple(tuple(row) for row in rows))
+
+@functools.lru_cache(maxsize=None)
+def _default_file_mode():
+    # mkstemp creates files as 0600, give them the mode a plain open() would
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def write_atomic(path, data):
+    # Write to a temp file in the same directory and rename it over the target,
+    # so readers only ever see the old file or the complete new one
+    with STATS.stage('io'):
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp',
+            dir=os.path.dirname(path) or '.'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, _default_file_mode())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+def kcm_input_digest(lang, layout_type):
+    # Hash of everything a KCM file is rendered from: CSV row, layouts, mapping entries and generator version
+    locale = lang['Locale']
+    key_labels = PHYSICAL_LAYOUTS[layout_type]['key_mapping'].values()
+    mappings = []
+    for name in resolve_mapping_chain(locale) + ('alt-sym',):
+        mapping = CHARACTER_MAPPINGS[name]
+        mappings.append([name, [[label, mapping[label]] for label in key_labels if label in mapping]])
+    
+    inputs = {
+        'version': GENERATOR_VERSION,
+        'row': lang,
+        'layout_type': layout_type,
+        'base_layout': sorted(PHYSICAL_LAYOUTS['QWERTY']['key_mapping'].items()),
+        'layout': sorted(PHYSICAL_LAYOUTS[layout_type]['key_mapping'].items()),
+        'rows': ROW_GROUPINGS,
+        'language_name': LANGUAGE_NAMES.get(locale, locale),
+        'mappings': mappings,
+    }
+    encoded = json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+def load_manifest(output_dir):
+    # Returns {kcm_filename: input_digest}, empty if the manifest is missing, unreadable or from another version
+    try:
+        with STATS.stage('io'), open(os.path.join(output_dir, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get('generator_version') != GENERATOR_VERSION:
+        return {}
+    return manifest.get('files', {})
+
+def save_manifest(output_dir, files):
+    manifest = {'generator_version': GENERATOR_VERSION, 'files': files}
+    data = json.dumps(manifest, sort_keys=True, indent=1, ensure_ascii=False) + '\n'
+    os.makedirs(output_dir, exist_ok=True)
+    write_atomic(os.path.join(output_dir, MANIFEST_FILENAME), data.encode('utf-8'))
+
+class ArchiveSink(KcmSink):
+    # Adds the encoded file to a KcmArchive under name
     
-    # Process each language entry
+    def __init__(self, archive, name):
+        super().__init__()
+        self.archive = archive
+        self.name = name
+    
+    def commit(self, data):
+        self.archive.add(self.name, data)
+
+class KcmArchive(object):
+    # Single zip or tar bundle of KCM files, written as a stream so it can go to stdout.
+    # Members get a fixed timestamp, owner and mode, and appear in the order they are
+    # added, so the same inputs always produce the same archive bytes.
+    
+    def __init__(self, fileobj, archive_format='zip', prefix='', mtime=None):
+        if archive_format not in ARCHIVE_FORMATS.values():
+            raise ValueError("Unknown archive format: {}".format(archive_format))
+        if mtime is None:
+            mtime = int(os.environ.get('SOURCE_DATE_EPOCH', DEFAULT_ARCHIVE_MTIME))
+        self.archive_format = archive_format
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.mtime = max(mtime, DEFAULT_ARCHIVE_MTIME)
+        self._gzip = None
+        
+        # Archive modules are only imported when a bundle is actually written
+        import gzip
+        import tarfile
+        import zipfile
+        
+        if archive_format == 'zip':
+            self._archive = zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            if archive_format == 'tar.gz':
+                # tarfile's own gzip stream stamps the current time, so wrap it ourselves
+                self._gzip = fileobj = gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, mtime=self.mtime)
+            self._archive = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT)
+    
+    def add(self, name, data):
+        import tarfile
+        import zipfile
+        
+        name = self.prefix + name
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(name, date_time=time.gmtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = 0o100644 << 16
+            with STATS.stage('io'):
+                self._archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            with STATS.stage('io'):
+                self._archive.addfile(info, io.BytesIO(data))
+    
+    def add_link(self, name, target, symbolic=False):
+        # Store name as a link to the already added member target. Zip has no hard
+        # links, so zip bundles always get a symlink entry (restored by unzip on Unix).
+        import tarfile
+        import zipfile
+        
+        relative_target = posixpath.relpath(target, posixpath.dirname(name) or '.')
+        name = self.prefix + name
+        if self.archive_format == 'zip':
+            info = zipfile.ZipInfo(name, date_time=time.gmtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.create_system = 3
+            info.external_attr = 0o120777 << 16
+            with STATS.stage('io'):
+                self._archive.writestr(info, relative_target.encode('utf-8'))
+        else:
+            info = tarfile.TarInfo(name)
+            info.mtime = self.mtime
+            if symbolic:
+                info.type = tarfile.SYMTYPE
+                info.linkname = relative_target
+                info.mode = 0o777
+            else:
+                info.type = tarfile.LNKTYPE
+                info.linkname = self.prefix + target
+                info.mode = 0o644
+            with STATS.stage('io'):
+                self._archive.addfile(info)
+    
+    def sink(self, name):
+        return ArchiveSink(self, name)
+    
+    def close(self):
+        self._archive.close()
+        if self._gzip is not None:
+            self._gzip.close()
+
+def archive_format_for(path):
+    # Guess the archive format from the file name, defaulting to zip
+    for extension, archive_format in sorted(ARCHIVE_FORMATS.items(), key=lambda item: -len(item[0])):
+        if path.lower().endswith(extension):
+            return archive_format
+    return 'zip'
+
+def kcm_body_digest(data):
+    # Digest of a rendered file from "type OVERLAY" on, which skips the header comment
+    # naming the language, so layouts that only differ in language name collide
+    return hashlib.sha256(data[data.find(b'\ntype ') + 1:]).hexdigest()
+
+class Deduplicator(object):
+    # Tracks distinct key bodies during a build. The first file seen with a body is
+    # stored normally, later ones are pointed at it.
+    
+    def __init__(self):
+        self.bodies = {}
+        self.files = 0
+        self.linked = 0
+        self.bytes_total = 0
+        self.bytes_saved = 0
+    
+    def canonical(self, name, data):
+        # Returns the name of an earlier file with the same body, or None if this one is new
+        self.files += 1
+        self.bytes_total += len(data)
+        target = self.bodies.setdefault(kcm_body_digest(data), name)
+        if target == name:
+            return None
+        self.linked += 1
+        self.bytes_saved += len(data)
+        return target
+    
+    def report(self):
+        return "Deduplicated {} of {} KCM files into {} distinct layouts ({:.2f}:1), saving {} of {} bytes".format(
+            self.linked, self.files, len(self.bodies), self.files / max(len(self.bodies), 1),
+            self.bytes_saved, self.bytes_total
+        )
+
+def link_atomic(target_path, path, symbolic=False):
+    # Replace path with a hard or relative symbolic link to target_path
+    with STATS.stage('io'):
+        tmp_path = os.path.join(os.path.dirname(path), '.{}.{}.tmp'.format(os.path.basename(path), os.getpid()))
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        if symbolic:
+            os.symlink(os.path.relpath(target_path, os.path.dirname(path)), tmp_path)
+        else:
+            os.link(target_path, tmp_path)
+        os.replace(tmp_path, path)
+
+def store_rendered(kcm_filename, data, output_dir, bundle=None, deduplicator=None, symbolic=False):
+    # Put one rendered file into the bundle or output directory, as a link if its body was seen before
+    target = deduplicator.canonical(kcm_filename, data) if deduplicator is not None else None
+    if bundle is not None:
+        if target is None:
+            bundle.add(kcm_filename, data)
+        else:
+            bundle.add_link(kcm_filename, target, symbolic)
+    else:
+        path = os.path.join(output_dir, kcm_filename)
+        if target is None:
+            write_atomic(path, data)
+        else:
+            link_atomic(os.path.join(output_dir, target), path, symbolic)
+    # A link writes no file contents, the bytes it stands for are in the dedup counters
+    STATS.add_file(kcm_filename, len(data) if target is None else 0)
+
+def iter_work_units(languages):
+    # Yields (unit, lang) for every unit build_work_units returns, with the languages.csv
+    # row it came from. Input digests must hash that row, a locale can have several.
     for lang in languages:
-        locale = lang['Locale']
+        for layout_type, column in LAYOUT_COLUMNS:
+            if lang[column]:
+                yield (lang['Locale'], layout_type, lang[column]), lang
+
+def build_work_units(languages):
+    # One (locale, layout_type, kcm_filename) unit per non-empty layout column, in CSV order
+    return [unit for unit, lang in iter_work_units(languages)]
+
+def generate_unit(unit, output_dir):
+    # Returns an error message instead of raising, so one bad locale doesn't stop the rest
+    locale, layout_type, kcm_filename = unit
+    try:
+        generate_kcm_file(locale, layout_type, kcm_filename, output_dir)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+def render_unit(unit):
+    # Like generate_unit, but returns (error, data) for the parent process to store
+    locale, layout_type, kcm_filename = unit
+    sink = BufferSink()
+    try:
+        render_kcm_to(sink, locale, layout_type)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e), None
+    return None, sink.getvalue()
+
+def instrumented_unit(worker, unit):
+    # Run worker(unit) in a pool process with stats enabled, returns (result, stats snapshot)
+    # covering only this unit, cache counters included, for the parent to merge
+    STATS.reset()
+    STATS.enabled = True
+    before = cache_counters()
+    result = worker(unit)
+    for name, value in cache_counters().items():
+        STATS.count(name, value - before[name])
+    return result, STATS.snapshot()
+
+def main(language_list_file, output_dir=None, jobs=1, force=False,
+         archive=None, archive_format=None, archive_prefix='', dedup=None):
+    # Read language list CSV
+    with STATS.stage('csv'):
+        languages = read_language_list(language_list_file)
+    
+    # Keep stdout clean when the archive itself is written there
+    log = functools.partial(print, file=sys.stderr) if archive == '-' else print
+    
+    # dedup is None, 'hardlink' or 'symlink'
+    deduplicator = Deduplicator() if dedup else None
+    
+    manifest = None
+    skipped = 0
+    if archive is None and deduplicator is None:
+        # Skip files whose inputs match the manifest from the previous run
+        previous = {} if force else load_manifest(output_dir)
+        manifest = {}
+        units = []
+        for unit, lang in iter_work_units(languages):
+            locale, layout_type, kcm_filename = unit
+            with STATS.stage('manifest'):
+                try:
+                    digest = kcm_input_digest(lang, layout_type)
+                except Exception:
+                    # Broken inputs, leave it to the build to report the failure
+                    digest = None
+                manifest[kcm_filename] = digest
+                up_to_date = digest is not None and previous.get(kcm_filename) == digest and os.path.exists(os.path.join(output_dir, kcm_filename))
+            if up_to_date:
+                skipped += 1
+            else:
+                units.append(unit)
+        STATS.count('manifest.up_to_date', skipped)
+        STATS.count('manifest.stale', len(units))
         
-        # Process QWERTY layout if specified
-        if lang['QWERTY_KCM']:
-            print("Generating QWERTY for {}: {}".format(locale, lang['QWERTY_KCM']))
-            generate_kcm_file(locale, 'QWERTY', lang['QWERTY_KCM'], output_dir)
+        worker = functools.partial(generate_unit, output_dir=output_dir)
+    else:
+        # Bundles and deduplicated trees are always written in full, rendered
+        # files come back here to be stored or linked in order
+        units = build_work_units(languages)
+        worker = render_unit
+    
+    # Pool processes keep their own stats, each result then carries a snapshot to merge
+    instrumented = STATS.enabled and not (jobs == 1 or len(units) < 2)
+    
+    if archive is None:
+        destination = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        if deduplicator is not None:
+            # Linked files would go stale behind a later incremental build, so drop the manifest
+            if os.path.exists(os.path.join(output_dir, MANIFEST_FILENAME)):
+                os.unlink(os.path.join(output_dir, MANIFEST_FILENAME))
+    else:
+        destination = '<stdout>' if archive == '-' else archive
         
-        # Process AZERTY layout if specified
-        if lang['AZERTY_KCM']:
-            print("Generating AZERTY for {}: {}".format(locale, lang['AZERTY_KCM']))
-            generate_kcm_file(locale, 'AZERTY', lang['AZERTY_KCM'], output_dir)
+        if archive == '-':
+            archive_file = sys.stdout.buffer
+            tmp_path = None
+        else:
+            archive_format = archive_format or archive_format_for(archive)
+            os.makedirs(os.path.dirname(archive) or '.', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.{}.'.format(os.path.basename(archive)), suffix='.tmp',
+                dir=os.path.dirname(archive) or '.'
+            )
+            archive_file = os.fdopen(fd, 'wb')
+        bundle = KcmArchive(archive_file, archive_format or 'zip', archive_prefix)
+    
+    if jobs == 1 or len(units) < 2:
+        results = map(worker, units)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
         
-        # Process QWERTZ layout if specified
-        if lang['QWERTZ_KCM']:
-            print("Generating QWERTZ for {}: {}".format(locale, lang['QWERTZ_KCM']))
-            generate_kcm_file(locale, 'QWERTZ', lang['QWERTZ_KCM'], output_dir)
-    
-    print("\nGenerated {} KCM files in {}".format(
-        sum(1 for lang in languages if any([lang['QWERTY_KCM'], lang['AZERTY_KCM'], lang['QWERTZ_KCM']])),
-        output_dir
-    ))
+        # executor.map yields in submission order, which keeps the log deterministic
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        chunksize = max(1, len(units) // (jobs * 4))
+        results = executor.map(
+            functools.partial(instrumented_unit, worker) if instrumented else worker,
+            units, chunksize=chunksize
+        )
+    
+    failures = []
+    try:
+        for (locale, layout_type, kcm_filename), result in zip(units, results):
+            log("Generating {} for {}: {}".format(layout_type, locale, kcm_filename))
+            if instrumented:
+                result, snapshot = result
+                STATS.merge(snapshot)
+            if worker is render_unit:
+                error, data = result
+                if error is None:
+                    try:
+                        store_rendered(kcm_filename, data, output_dir, bundle if archive else None,
+                                       deduplicator, symbolic=dedup == 'symlink')
+                    except OSError as e:
+                        error = "{}: {}".format(type(e).__name__, e)
+            else:
+                error = result
+            if error is not None:
+                log("  Failed: {}".format(error))
+                failures.append((locale, layout_type, error))
+                if manifest is not None:
+                    del manifest[kcm_filename]
+    except BaseException:
+        if archive is not None and tmp_path is not None:
+            archive_file.close()
+            os.unlink(tmp_path)
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    if archive is None:
+        if manifest is not None:
+            save_manifest(output_dir, manifest)
+    else:
+        bundle.close()
+        if tmp_path is None:
+            archive_file.flush()
+        else:
+            archive_file.close()
+            os.chmod(tmp_path, _default_file_mode())
+            os.replace(tmp_path, archive)
+    
+    log("\nGenerated {} KCM files in {}".format(len(units) - len(failures), destination))
+    if skipped:
+        log("{} KCM files were up to date".format(skipped))
+    if deduplicator is not None:
+        STATS.count('dedup.linked', deduplicator.linked)
+        STATS.count('dedup.distinct', len(deduplicator.bodies))
+        STATS.count('dedup.bytes_saved', deduplicator.bytes_saved)
+        log(deduplicator.report())
+    
+    if failures:
+        log("{} KCM files failed:".format(len(failures)))
+        for locale, layout_type, error in failures:
+            log("  {} {}: {}".format(locale, layout_type, error))
+    
+    return failures
+
+def unit_dependencies(locale, layout_type):
+    # Every source a generated file is built from: its CSV row, header name, base and
+    # target physical layout, the alt-sym table and both mapping candidates (whether or
+    # not the files exist yet, so adding hy_AM.json next to hy.json is picked up)
+    keys = [
+        ('csv', locale),
+        ('name', locale),
+        ('layout', 'QWERTY'),
+        ('layout', layout_type),
+        ('mapping', 'alt-sym'),
+        ('mapping', locale),
+        ('mapping', locale.split('_')[0]),
+    ]
+    return set(keys)
+
+def build_dependency_graph(units):
+    # Maps each source key from unit_dependencies to the output files that depend on it
+    graph = defaultdict(set)
+    for locale, layout_type, kcm_filename in units:
+        for key in unit_dependencies(locale, layout_type):
+            graph[key].add(kcm_filename)
+    return graph
+
+def snapshot_sources(language_list_file):
+    # (mtime_ns, size) of languages.csv and every data file
+    paths = [language_list_file, PHYSICAL_LAYOUTS.path, LANGUAGE_NAMES.path]
+    paths.extend(
+        os.path.join(CHARACTER_MAPPINGS.path, name)
+        for name in os.listdir(CHARACTER_MAPPINGS.path) if name.endswith('.json')
+    )
+    snapshot = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+def rows_by_locale(languages):
+    # languages.csv rows grouped by locale, so a change to any row of a locale is seen
+    rows = defaultdict(list)
+    for lang in languages:
+        rows[lang['Locale']].append(lang)
+    return dict(rows)
+
+def read_language_list(language_list_file):
+    with open(language_list_file, 'r', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+def changed_entries(old, new, kind):
+    # Source keys for the entries of two dict snapshots that were added, removed or edited
+    return {(kind, key) for key in set(old) | set(new) if old.get(key) != new.get(key)}
+
+def watch(language_list_file, output_dir, jobs=1, force=False, interval=1.0):
+    # Build once, then poll the CSV and data files and regenerate only the files whose
+    # sources changed, keeping the incremental manifest up to date
+    main(language_list_file, output_dir, jobs=jobs, force=force)
+    
+    languages = read_language_list(language_list_file)
+    rows = rows_by_locale(languages)
+    units = build_work_units(languages)
+    graph = build_dependency_graph(units)
+    layouts = {layout_type: dict(layout['key_mapping']) for layout_type, layout in PHYSICAL_LAYOUTS.items()}
+    names = dict(LANGUAGE_NAMES)
+    snapshot = snapshot_sources(language_list_file)
+    
+    print("\nWatching {} and {} for changes, press Ctrl+C to stop".format(language_list_file, DATA_DIR))
+    try:
+        while True:
+            time.sleep(interval)
+            current = snapshot_sources(language_list_file)
+            changed_paths = {path for path in set(snapshot) | set(current) if snapshot.get(path) != current.get(path)}
+            snapshot = current
+            if not changed_paths:
+                continue
+            
+            changed = set()
+            try:
+                mapping_names = [
+                    os.path.basename(path)[:-len('.json')]
+                    for path in changed_paths if os.path.dirname(path) == CHARACTER_MAPPINGS.path
+                ]
+                changed.update(('mapping', name) for name in mapping_names)
+                reload_data(mapping_names)
+                
+                new_layouts = {layout_type: dict(layout['key_mapping']) for layout_type, layout in PHYSICAL_LAYOUTS.items()}
+                changed.update(changed_entries(layouts, new_layouts, 'layout'))
+                layouts = new_layouts
+                
+                new_names = dict(LANGUAGE_NAMES)
+                changed.update(changed_entries(names, new_names, 'name'))
+                names = new_names
+                
+                if language_list_file in changed_paths:
+                    languages = read_language_list(language_list_file)
+                    new_rows = rows_by_locale(languages)
+                    changed.update(changed_entries(rows, new_rows, 'csv'))
+                    rows = new_rows
+                    units = build_work_units(languages)
+                    graph = build_dependency_graph(units)
+            except (OSError, ValueError, KeyError) as e:
+                # Most likely a file caught halfway through being saved, retry on its next change
+                print("Could not reload sources: {}: {}".format(type(e).__name__, e))
+                continue
+            
+            affected = set()
+            for key in changed:
+                affected.update(graph.get(key, ()))
+            if not affected:
+                continue
+            
+            manifest = load_manifest(output_dir)
+            regenerated = 0
+            failed = 0
+            for unit, lang in iter_work_units(languages):
+                locale, layout_type, kcm_filename = unit
+                if kcm_filename not in affected:
+                    continue
+                print("Regenerating {} for {}: {}".format(layout_type, locale, kcm_filename))
+                error = generate_unit(unit, output_dir)
+                if error is None:
+                    try:
+                        manifest[kcm_filename] = kcm_input_digest(lang, layout_type)
+                    except Exception as e:
+                        error = "{}: {}".format(type(e).__name__, e)
+                if error is None:
+                    regenerated += 1
+                else:
+                    print("  Failed: {}".format(error))
+                    manifest.pop(kcm_filename, None)
+                    failed += 1
+            save_manifest(output_dir, manifest)
+            print("Regenerated {} of {} KCM files".format(regenerated, len(units)))
+            if failed:
+                print("{} KCM files failed".format(failed))
+    except KeyboardInterrupt:
+        pass
+
+# Modifier planes of a KeyRecord, in the order the KCM file lists them
+MODIFIERS = ('base', 'shift', 'alt', 'sym')
+
+class ValidationIssue(object):
+    # One finding, with every (locale, layout) or data file it was seen in
+    __slots__ = ('severity', 'code', 'message', 'locations')
+    
+    def __init__(self, severity, code, message, locations):
+        self.severity = severity
+        self.code = code
+        self.message = message
+        self.locations = locations
+    
+    def __str__(self):
+        shown = ', '.join(self.locations[:5])
+        if len(self.locations) > 5:
+            shown += ', ... {} more'.format(len(self.locations) - 5)
+        return "{}: {}: {} [{}]".format(self.severity, self.code, self.message, shown)
+
+@functools.lru_cache(maxsize=None)
+def check_character(value):
+    # Returns (character, problem) for a mapping value as it will be written to the KCM file
+    if any(ord(c) > 0xFFFF for c in value):
+        return value, "outside the Basic Multilingual Plane, \\uXXXX cannot encode it"
+    try:
+        return decode_kcm_literal(unicode_escape(value)), None
+    except ValueError as e:
+        return value, str(e)
+
+def build_character_index(units):
+    # Reverse index from each produced character to its (locale, layout_type, key label, modifier)
+    # entries, plus a list of (locale, layout_type, error) for layouts that failed to compile
+    index = defaultdict(list)
+    failed = []
+    for locale, layout_type, kcm_filename in units:
+        try:
+            layout = compile_layout(locale, layout_type)
+        except Exception as e:
+            failed.append((locale, layout_type, "{}: {}".format(type(e).__name__, e)))
+            continue
+        for key in layout.keys:
+            for modifier in MODIFIERS:
+                index[check_character(getattr(key, modifier))[0]].append((locale, layout_type, key.label, modifier))
+    return index, failed
+
+def validate_matrix(languages):
+    # Check the data files once and the whole locale x layout matrix in a single pass.
+    # Returns ValidationIssues sorted errors first; identical findings from different
+    # layouts are merged into one issue.
+    found = defaultdict(list)
+    
+    def report(severity, code, message, location):
+        found[(severity, code, message)].append(location)
+    
+    # Physical layouts: every scancode of every row present and each letter on one key
+    layout_labels = set()
+    for layout_type in PHYSICAL_LAYOUTS:
+        labels = scancode_labels(layout_type)
+        seen = {}
+        for key_codes in ROW_GROUPINGS.values():
+            for key_code in key_codes:
+                if labels[key_code] is None:
+                    report('warning', 'missing-key', "no key for scancode {}".format(key_code), layout_type)
+                elif labels[key_code] in seen:
+                    report('error', 'duplicate', "{} on scancodes {} and {}".format(
+                        labels[key_code], seen[labels[key_code]], key_code), layout_type)
+                else:
+                    seen[labels[key_code]] = key_code
+        layout_labels.update(seen)
+    
+    # Mapping files: every value must survive escaping and every letter should be covered
+    mapping_chars = {}
+    for name in CHARACTER_MAPPINGS:
+        location = '{}.json'.format(name)
+        try:
+            mapping = CHARACTER_MAPPINGS[name]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            report('error', 'load', "{}: {}".format(type(e).__name__, e), location)
+            continue
+        chars = mapping_chars[name] = {}
+        for label in sorted(layout_labels - set(mapping)):
+            if name == 'alt-sym':
+                report('error', 'missing-key', "no entry for {}".format(label), location)
+            else:
+                report('warning', 'missing-key', "no entry for {}, falls back to Latin".format(label), location)
+        for label, values in mapping.items():
+            if label not in layout_labels:
+                report('warning', 'unreachable', "{} is not a key on any physical layout".format(label), location)
+                continue
+            if len(values) != 2:
+                report('error', 'load', "{} has {} values, expected 2".format(label, len(values)), location)
+                continue
+            for modifier, value in zip(MODIFIERS[2:] if name == 'alt-sym' else MODIFIERS[:2], values):
+                char, problem = check_character(value)
+                if problem is not None:
+                    report('error', 'escape', "{} {} {!r}: {}".format(label, modifier, value, problem), location)
+                chars.setdefault(char, (label, modifier))
+    
+    # Matrix: one pass over every generated layout through the reverse index
+    units = build_work_units(languages)
+    index, failed = build_character_index(units)
+    for locale, layout_type, error in failed:
+        report('error', 'compile', error, '{} {}'.format(locale, layout_type))
+    for locale in sorted({locale for locale, layout_type, kcm_filename in units} - set(LANGUAGE_NAMES)):
+        report('warning', 'missing-name', "no entry in language_names.json", locale)
+    
+    for char, entries in index.items():
+        # Same character on two different keys of one layout and modifier
+        keys_by_plane = defaultdict(list)
+        for locale, layout_type, label, modifier in entries:
+            keys_by_plane[(locale, layout_type, modifier)].append(label)
+        for (locale, layout_type, modifier), labels in keys_by_plane.items():
+            if len(labels) > 1:
+                report('warning', 'duplicate', "{} {!r} on keys {}".format(modifier, char, ', '.join(labels)),
+                       '{} {}'.format(locale, layout_type))
+    
+    for name, chars in mapping_chars.items():
+        for char, (label, modifier) in chars.items():
+            if char not in index:
+                report('warning', 'unreachable', "{} {} {!r} is not produced by any layout in the CSV".format(
+                    label, modifier, char), '{}.json'.format(name))
+    
+    issues = [
+        ValidationIssue(severity, code, message, locations)
+        for (severity, code, message), locations in found.items()
+    ]
+    issues.sort(key=lambda issue: (issue.severity != 'error', issue.code, issue.message))
+    return issues
+
+def validate(language_list_file, strict=False):
+    # Print every issue, return True if the matrix passes (no errors, and no warnings if strict)
+    issues = validate_matrix(read_language_list(language_list_file))
+    for issue in issues:
+        print(issue)
+    errors = sum(1 for issue in issues if issue.severity == 'error')
+    print("\n{} errors, {} warnings".format(errors, len(issues) - errors))
+    return not (errors or (strict and issues))
+
+def diff_layouts(expected, actual):
+    # Key-level differences between two KeyLayouts as (label, modifier, expected, actual),
+    # modifier None for a key missing on one side. Values are compared as the character
+    # the keyboard ends up with, so equivalent escapes don't count as a difference.
+    expected_keys = {key.label: key for key in expected}
+    actual_keys = {key.label: key for key in actual}
+    differences = []
+    for label, key in expected_keys.items():
+        other = actual_keys.get(label)
+        if other is None:
+            differences.append((label, None, 'present', 'missing'))
+            continue
+        for modifier in MODIFIERS:
+            expected_value = getattr(key, modifier)
+            actual_value = getattr(other, modifier)
+            if actual_value is None or check_character(expected_value)[0] != check_character(actual_value)[0]:
+                differences.append((label, modifier, expected_value, actual_value))
+    for label in actual_keys:
+        if label not in expected_keys:
+            differences.append((label, None, 'missing', 'present'))
+    return differences
+
+def diff_directory(language_list_file, directory):
+    # Compare every KCM file languages.csv lists against what would be generated, without
+    # writing anything. Prints one line per difference, returns the number of differing files.
+    units = build_work_units(read_language_list(language_list_file))
+    differing = 0
+    for locale, layout_type, kcm_filename in units:
+        path = os.path.join(directory, kcm_filename)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                actual = parse_kcm(f, locale, layout_type)
+            differences = diff_layouts(compile_layout(locale, layout_type), actual)
+        except FileNotFoundError:
+            differences = None
+            print("{}: missing".format(kcm_filename))
+        except (OSError, ValueError, KeyError) as e:
+            differences = None
+            print("{}: {}: {}".format(kcm_filename, type(e).__name__, e))
+        
+        if differences is None:
+            differing += 1
+            continue
+        if differences:
+            differing += 1
+        for label, modifier, expected_value, actual_value in differences:
+            if modifier is None:
+                print("{}: key {} {} (expected {})".format(kcm_filename, label, actual_value, expected_value))
+            else:
+                print("{}: key {} {}: expected {!r}, found {!r}".format(
+                    kcm_filename, label, modifier, expected_value, actual_value))
+    
+    print("\n{} of {} KCM files differ".format(differing, len(units)))
+    return differing
 
 if __name__ == "__main__":
     import argparse
     
     parser = argparse.ArgumentParser(description='Generate KCM files for keyboard layouts')
     parser.add_argument('language_list', help='CSV file containing language layouts')
-    parser.add_argument('output_dir', help='Output directory for KCM files')
+    parser.add_argument('output_dir', nargs='?', help='Output directory for KCM files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes, 0 for one per CPU (default: 1)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Regenerate every file, ignoring the incremental build manifest')
+    parser.add_argument('-a', '--archive', metavar='PATH',
+                        help='Write all KCM files into a single zip or tar archive instead, - for stdout')
+    parser.add_argument('--archive-format', choices=sorted(set(ARCHIVE_FORMATS.values())),
+                        help='Archive format (default: from the archive extension, else zip)')
+    parser.add_argument('--archive-prefix', default='', metavar='PREFIX',
+                        help='Directory inside the archive, e.g. system/usr/keychars for a Magisk module')
+    parser.add_argument('--dedup', choices=['hardlink', 'symlink'],
+                        help='Store each distinct key layout once and link files that only differ in their '
+                             'header comment to it (zip bundles always use symlinks). Implies --force.')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running and regenerate the files affected by each change to the CSV or data files')
+    parser.add_argument('--validate', action='store_true',
+                        help='Check the mappings and the whole layout matrix instead of generating, exit 1 on errors')
+    parser.add_argument('--diff', metavar='DIR',
+                        help='Compare the KCM files in DIR against what would be generated, exit 1 on differences')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='Serve rendered layouts over HTTP on [HOST:]PORT or unix:PATH instead of generating')
+    parser.add_argument('--strict', action='store_true', help='With --validate, also fail on warnings')
+    parser.add_argument('--interval', type=float, default=1.0, metavar='SECONDS',
+                        help='Polling interval for --watch (default: 1.0)')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='Write per-stage timings, cache counters and per-file sizes as JSON, - for stderr')
+    parser.add_argument('--profile', type=int, nargs='?', const=25, metavar='N',
+                        help='Run the build under cProfile and print the N hottest functions to stderr '
+                             '(default: 25), only the parent process is profiled with --jobs')
     
     args = parser.parse_args()
+    if args.jobs < 0:
+        parser.error('--jobs must be 0 or a positive number of worker processes')
+    if args.validate:
+        sys.exit(0 if validate(args.language_list, strict=args.strict) else 1)
+    if args.diff:
+        sys.exit(1 if diff_directory(args.language_list, args.diff) else 0)
+    if args.serve:
+        import kcm_server
+        kcm_server.serve(args.serve, args.language_list)
+        sys.exit(0)
+    if (args.output_dir is None) == (args.archive is None):
+        parser.error('exactly one of output_dir or --archive is required')
+    if args.watch and (args.archive or args.dedup):
+        parser.error('--watch only supports plain output_dir builds')
+    if args.watch and (args.stats or args.profile):
+        parser.error('--stats and --profile are not supported with --watch')
+    
+    if args.watch:
+        watch(args.language_list, args.output_dir, jobs=args.jobs or os.cpu_count(), force=args.force,
+              interval=args.interval)
+        sys.exit(0)
+    
+    build = functools.partial(
+        main, args.language_list, args.output_dir, jobs=args.jobs or os.cpu_count(), force=args.force,
+        archive=args.archive, archive_format=args.archive_format, archive_prefix=args.archive_prefix,
+        dedup=args.dedup
+    )
+    
+    STATS.enabled = args.stats is not None
+    start = time.perf_counter()
+    if args.profile:
+        import cProfile
+        import pstats
+        
+        profiler = cProfile.Profile()
+        failures = profiler.runcall(build)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(args.profile)
+    else:
+        failures = build()
+    total_seconds = time.perf_counter() - start
     
-    main(args.language_list, args.output_dir)
+    if args.stats:
+        report = json.dumps(STATS.report(total_seconds, cache_counters()), indent=2) + '\n'
+        if args.stats == '-':
+            sys.stderr.write(report)
+        else:
+            with open(args.stats, 'w', encoding='utf-8') as f:
+                f.write(report)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,255 @@
+import os
+import sys
+import stat
+import errno
+import signal
+import hashlib
+import threading
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import generate_kcm
+
+class RenderCache(object):
+    # Rendered KCM bytes and ETag by (locale, layout_type), bounded LRU. Each entry
+    # remembers the input digest it was rendered from, so reload() only drops the
+    # entries whose data files actually changed.
+    #
+    # The lock only guards the bookkeeping, rendering happens outside it. A miss
+    # leaves a Future in _pending that later requests for the same layout wait on,
+    # so each layout is rendered once however many requests ask for it at once.
+    
+    def __init__(self, max_entries=generate_kcm.KEY_TABLE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+    
+    def get(self, locale, layout_type):
+        # Returns (data, etag), rendering on a miss
+        key = (locale, layout_type)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1:]
+            
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = Future()
+                generation = self._generation
+                self.misses += 1
+            else:
+                self.hits += 1
+                generation = None
+        
+        if generation is None:
+            # Another request is rendering this layout, its error is ours too
+            return pending.result()
+        
+        try:
+            digest = generate_kcm.kcm_input_digest({'Locale': locale}, layout_type)
+            sink = generate_kcm.BufferSink()
+            generate_kcm.render_kcm_to(sink, locale, layout_type)
+            data = sink.getvalue()
+            entry = (digest, data, '"{}"'.format(hashlib.sha256(data).hexdigest()[:32]))
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+        
+        with self._lock:
+            del self._pending[key]
+            # A reload while rendering may have mixed old and new data, serve it once but don't keep it
+            if generation == self._generation:
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        pending.set_result(entry[1:])
+        return entry[1:]
+    
+    def reload(self):
+        # Re-read the data files, returns (kept, dropped) cache entry counts.
+        # Requests keep being served from the cache while the digests are compared.
+        with self._reload_lock:
+            generate_kcm.reload_data()
+            with self._lock:
+                self._generation += 1
+                entries = list(self._entries.items())
+            
+            stale = []
+            for key, entry in entries:
+                try:
+                    digest = generate_kcm.kcm_input_digest({'Locale': key[0]}, key[1])
+                except Exception:
+                    digest = None
+                if digest != entry[0]:
+                    stale.append((key, entry))
+            
+            with self._lock:
+                for key, entry in stale:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                return len(self._entries), len(stale)
+
+class KcmRequestHandler(BaseHTTPRequestHandler):
+    # GET/HEAD /kcm/<kcm_filename> for a file listed in languages.csv,
+    # GET/HEAD /kcm/<layout_type>/<locale> for any known locale, POST /reload
+    server_version = 'generate_kcm'
+    
+    def do_GET(self):
+        self.send_kcm(include_body=True)
+    
+    def do_HEAD(self):
+        self.send_kcm(include_body=False)
+    
+    def do_POST(self):
+        if self.path.split('?')[0] != '/reload':
+            self.send_text(404, "Not found\n")
+            return
+        try:
+            kept, dropped = self.server.reload()
+        except Exception as e:
+            self.send_text(500, "Reload failed: {}: {}\n".format(type(e).__name__, e))
+            return
+        self.send_text(200, "Reloaded, kept {} cached layouts, dropped {}\n".format(kept, dropped))
+    
+    def send_kcm(self, include_body):
+        parts = [unquote(part) for part in self.path.split('?')[0].strip('/').split('/')]
+        if len(parts) == 2 and parts[0] == 'kcm' and parts[1] in self.server.units:
+            locale, layout_type = self.server.units[parts[1]]
+        elif (len(parts) == 3 and parts[0] == 'kcm' and parts[1] in generate_kcm.PHYSICAL_LAYOUTS
+              and self.server.known_locale(parts[2])):
+            layout_type, locale = parts[1], parts[2]
+        else:
+            self.send_text(404, "Not found\n")
+            return
+        
+        try:
+            data, etag = self.server.cache.get(locale, layout_type)
+        except Exception as e:
+            self.send_text(500, "Render failed: {}: {}\n".format(type(e).__name__, e))
+            return
+        
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if include_body:
+            self.wfile.write(data)
+    
+    def send_text(self, status, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+class KcmServerMixin(object):
+    # Shared state of the TCP and Unix socket servers: the render cache and the
+    # kcm_filename -> (locale, layout_type) index built from languages.csv
+    daemon_threads = True
+    
+    def setup_kcm(self, language_list_file):
+        self.language_list_file = language_list_file
+        self.cache = RenderCache()
+        self.load_units()
+    
+    def load_units(self):
+        languages = generate_kcm.read_language_list(self.language_list_file)
+        self.units = {
+            kcm_filename: (locale, layout_type)
+            for locale, layout_type, kcm_filename in generate_kcm.build_work_units(languages)
+        }
+        self.locales = frozenset(lang['Locale'] for lang in languages)
+    
+    def known_locale(self, locale):
+        # A locale with a CSV row, a mapping or a language name, anything else would just
+        # render the Latin fallback under a made-up header and take up a cache slot
+        return (locale in self.locales or bool(generate_kcm.resolve_mapping_chain(locale))
+                or locale in generate_kcm.LANGUAGE_NAMES)
+    
+    def reload(self):
+        kept, dropped = self.cache.reload()
+        self.load_units()
+        return kept, dropped
+
+class KcmHTTPServer(KcmServerMixin, ThreadingHTTPServer):
+    pass
+
+class KcmUnixHTTPServer(KcmServerMixin, socketserver.ThreadingUnixStreamServer):
+    pass
+
+def make_server(address, language_list_file):
+    # address is [HOST:]PORT or unix:PATH
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        # Only clear away a socket left by an earlier run, never a file someone pointed us at
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(errno.EEXIST, "Refusing to replace a file that is not a socket", path)
+            os.unlink(path)
+        server = KcmUnixHTTPServer(path, KcmRequestHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = KcmHTTPServer((host or '127.0.0.1', int(port)), KcmRequestHandler)
+    server.setup_kcm(language_list_file)
+    return server
+
+def serve(address, language_list_file):
+    server = make_server(address, language_list_file)
+    
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    
+    # SIGTERM stops like Ctrl+C, SIGHUP reloads like POST /reload off the signal handler's thread
+    signal.signal(signal.SIGTERM, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=server.reload, daemon=True).start())
+    
+    print("Serving KCM layouts on {}, press Ctrl+C to stop".format(address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if address.startswith('unix:'):
+            os.unlink(address[len('unix:'):])
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Serve rendered KCM layouts over HTTP')
+    parser.add_argument('language_list', help='CSV file containing language layouts')
+    parser.add_argument('address', help='[HOST:]PORT or unix:PATH to listen on')
+    
+    args = parser.parse_args()
+    
+    serve(args.address, args.language_list)